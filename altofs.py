@@ -4,7 +4,17 @@
 # Bob Sproull  4/2018   rfsproull@gmail.com
 
 #
-import os,sys,string
+import os,sys,string,struct,fnmatch,zlib
+from collections import OrderedDict
+from array import array
+try:
+    import lzma     # Python 3 only
+except ImportError:
+    lzma = None
+try:
+    import fcntl    # advisory file locks, where the os has them
+except ImportError:
+    fcntl = None
 
 # Printing done in a way that works in Pythons 2 and 3
 def pr(s, no_cr=False):
@@ -96,6 +106,11 @@ def set_BCPL_string(put_w, s):
             w = ch << 8
         put_w((ci+1)//2, w)
 
+# Swap the bytes of each word in a bytearray of even length, in place
+# (.dsk files are byte-swapped compared to Alto byte order)
+def swap_bytes(ba):
+    ba[0::2], ba[1::2] = ba[1::2], ba[0::2]
+
 # get left (idx even) or right (idx odd byte)
 def get_byte(wd, idx):
     if (idx & 1) == 0:
@@ -137,6 +152,7 @@ def get_host_text_type():
 LEADER_ADJUST = 1        # used in calculations that adjust for leader in file (e.g., numChars)
 
 DSK_FILE_SEC_HEADER = 1  # document 1 word of header in .dsk files for each sector
+ALTO_TIME_OFFSET = 2177452800   # Alto times are seconds from 1901; Unix times from 1970
 VDA_FIX = True           # Trident sector permutation bug
 
 
@@ -164,28 +180,32 @@ VDA_FIX = True           # Trident sector permutation bug
 
 # BEWARE that .dsk files are byte-swapped !!!!!!!
 
-class Indexed_IO:
+# A disk's _sector(vda) returns the buffer holding the sector and the byte offset of
+# the sector in it, so that a whole disk image can be held in one buffer.
+
+class Indexed_IO(object):
+    __slots__ = ()
 
     def get_word(self, idx, vda=None):
         disk = self.disk
         if vda is not None:
             # Read from disk sector
-            ba = disk._get_ba(vda)
-            return self._get_word_from_bytes(ba, idx + disk.index_offset)
+            ba, base = disk._sector(vda)
+            return self._get_word_from_bytes(ba, idx + disk.index_offset, base)
         # Read from file
-        ba = disk._get_ba(self.file_vdas[(idx // disk.DD_len) + LEADER_ADJUST])
-        return self._get_word_from_bytes(ba, (idx % disk.DD_len) + disk.index_offset)
+        ba, base = disk._sector(self.file_vdas[(idx // disk.DD_len) + LEADER_ADJUST])
+        return self._get_word_from_bytes(ba, (idx % disk.DD_len) + disk.index_offset, base)
 
     def set_word(self, idx, w, vda=None):
         disk = self.disk
         if vda is not None:
             # Write into disk sector
-            ba = disk._get_ba(vda, True)
-            self._set_bytes_from_word(ba, idx + disk.index_offset, w)
+            ba, base = disk._sector(vda, True)
+            self._set_bytes_from_word(ba, idx + disk.index_offset, w, base)
         else:
             # Write into file
-            ba = disk._get_ba(self.file_vdas[(idx // disk.DD_len) + LEADER_ADJUST], True)
-            self._set_bytes_from_word(ba, (idx % disk.DD_len) + disk.index_offset, w)
+            ba, base = disk._sector(self.file_vdas[(idx // disk.DD_len) + LEADER_ADJUST], True)
+            self._set_bytes_from_word(ba, (idx % disk.DD_len) + disk.index_offset, w, base)
 
     # works only for data bytes (not header or label, but works for leader data)
     def get_byte(self, idx, vda=None):
@@ -203,16 +223,343 @@ class Indexed_IO:
 
     # define conversion from bytes read from file to words
     # disk-image files (.dsk) are byte-swapped compared to binary files in big-endian order
-    def _get_word_from_bytes(self, ba, word_idx):
-        ci = word_idx*2
+    # base is the byte offset of the sector in ba
+    def _get_word_from_bytes(self, ba, word_idx, base=0):
+        ci = base + word_idx*2
         return (ba[ci+1] << 8) + ba[ci] # byte-swap
 
     # inverse of _word_from_bytes
-    def _set_bytes_from_word(self, ba, word_idx, w):
-        ci = word_idx*2
+    def _set_bytes_from_word(self, ba, word_idx, w, base=0):
+        ci = base + word_idx*2
         ba[ci]   = w & 0o377 # byte-swap
         ba[ci+1] = w >> 8    # byte-swap
 
+## ********************************************************************************************************
+##        CLASS OVERLAY
+## ********************************************************************************************************
+
+# An overlay file holds the sectors that have been changed on a disk image, which is
+# then never written.  The overlay names the file beneath it, either the disk image or
+# another overlay, so overlays can be stacked.  The file is:
+#     OVERLAY_MAGIC
+#     name of the file beneath (relative to the overlay's directory), newline
+#     records: vda (4 bytes), length (4 bytes), sector contents
+# A sector is written in place if the overlay already holds it, else appended.
+
+OVERLAY_EXT = '.ovl'
+OVERLAY_MAGIC = b"AFU overlay 1\n"
+
+class Overlay:
+
+    # Make a new, empty overlay on top of a disk image or another overlay
+    @classmethod
+    def create(cls, fullfilename, base_filename):
+        if os.path.exists(fullfilename):
+            raise Exception("Overlay file " + fullfilename + " already exists.")
+        if not os.path.exists(base_filename):
+            raise Exception("Cannot find " + base_filename + " to put an overlay on.")
+        base_name = os.path.relpath(base_filename, os.path.dirname(os.path.abspath(fullfilename)))
+        with open(fullfilename, "wb") as f:
+            f.write(OVERLAY_MAGIC + base_name.encode('utf-8') + b"\n")
+            f.close()
+        return cls(fullfilename)
+
+    def __init__(self, fullfilename):
+        self.fullfilename = fullfilename
+        # opened for writing on the first put, so that the layers beneath the top one,
+        # which are never written, may be read-only
+        self.fil = open(fullfilename, "rb")
+        self.writable = False
+        if self.fil.readline() != OVERLAY_MAGIC:
+            raise Exception("File " + fullfilename + " is not an overlay.")
+        base_name = self.fil.readline().rstrip(b"\n").decode('utf-8')
+        self.base_filename = os.path.normpath(os.path.join(os.path.dirname(fullfilename), base_name))
+        # The layer beneath is another overlay, or None if it is the disk image itself
+        self.base = None
+        self.image_filename = self.base_filename
+        if os.path.splitext(self.base_filename)[1].lower() == OVERLAY_EXT:
+            self.base = Overlay(self.base_filename)
+            self.image_filename = self.base.image_filename
+        # index: vda -> (position of sector contents, length)
+        self.index = {}
+        pos = self.fil.tell()
+        while True:
+            rec = self.fil.read(8)
+            if len(rec) < 8: break
+            vda, n = struct.unpack("<II", rec)
+            self.index[vda] = (pos + 8, n)
+            pos += 8 + n
+            self.fil.seek(pos)
+
+    # vdas held anywhere in the stack of overlays
+    def vdas(self):
+        result = set(self.index)
+        if self.base is not None: result |= self.base.vdas()
+        return result
+
+    # Return contents of a sector, or None if no overlay in the stack holds it
+    def get(self, vda):
+        if vda in self.index:
+            pos, n = self.index[vda]
+            self.fil.seek(pos)
+            return bytearray(self.fil.read(n))
+        if self.base is None: return None
+        return self.base.get(vda)
+
+    def put(self, vda, ba):
+        if not self.writable:
+            self.fil.close()
+            self.fil = open(self.fullfilename, "r+b")
+            self.writable = True
+        if vda in self.index and self.index[vda][1] == len(ba):
+            self.fil.seek(self.index[vda][0])
+        else:
+            self.fil.seek(0, 2)   # end of file
+            self.fil.write(struct.pack("<II", vda, len(ba)))
+            self.index[vda] = (self.fil.tell(), len(ba))
+        self.fil.write(ba)
+
+    def close(self):
+        self.fil.close()
+        if self.base is not None: self.base.close()
+
+    # Delete the overlay file, discarding its changes
+    def remove(self):
+        self.close()
+        os.remove(self.fullfilename)
+
+## ********************************************************************************************************
+##        CLASS COMPRESSED IMAGE
+## ********************************************************************************************************
+
+# A compressed image file holds a raw disk image (.dsk, .dsk80 or .dsk300) in chunks of
+# COMPRESSED_CHUNK_SECTORS sectors, each compressed separately, so that any sector can be
+# read by decompressing one chunk.  A chunk of all zero bytes (never written by the
+# emulator) is stored as an empty run, with no data.  The file is:
+#     COMPRESSED_MAGIC
+#     header: raw image extension (16 bytes), sector length in bytes, number of sectors,
+#             sectors per chunk (4 bytes each), codec (1 byte: 0 zlib, 1 lzma)
+#     compressed chunks
+#     index: for each chunk, position (8 bytes) and length (4 bytes; 0 for an empty run)
+#     position of the index (8 bytes)
+# A CompressedImage acts as a file holding the raw image (seek, read, write), so the
+# Disk classes read compressed images as they do raw ones.  Chunks that are written are
+# held in memory, and the file is rewritten when closed; other chunks are copied as they are.
+
+COMPRESSED_EXT = '.dskz'
+COMPRESSED_MAGIC = b"AFU compressed disk image 1\n"
+COMPRESSED_HEADER = "<16sIIIB"
+COMPRESSED_CHUNK_SECTORS = 64
+COMPRESSED_CACHE_CHUNKS = 16     # decompressed chunks held for reading
+COMPRESSED_CODECS = ('zlib', 'lzma')
+
+class CompressedImage:
+
+    def __init__(self, fullfilename, mode="rb"):
+        self.name = fullfilename
+        self.writable = mode != "rb"
+        self.fil = open(fullfilename, "rb")
+        if self.fil.read(len(COMPRESSED_MAGIC)) != COMPRESSED_MAGIC:
+            raise Exception("File " + fullfilename + " is not a compressed disk image.")
+        ext, self.sec_bytes, self.n_sectors, self.chunk_sectors, self.codec = \
+            struct.unpack(COMPRESSED_HEADER, self.fil.read(struct.calcsize(COMPRESSED_HEADER)))
+        self.ext = ext.rstrip(b"\0").decode('ascii')
+        self.size = self.n_sectors * self.sec_bytes   # bytes in the raw image
+        self.chunk_bytes = self.chunk_sectors * self.sec_bytes
+        n_chunks = (self.n_sectors + self.chunk_sectors - 1) // self.chunk_sectors
+        self.fil.seek(-8, 2)
+        self.fil.seek(struct.unpack("<Q", self.fil.read(8))[0])
+        index = self.fil.read(12 * n_chunks)
+        self.index = [struct.unpack_from("<QI", index, 12*c) for c in range(n_chunks)]
+        self.cache = OrderedDict()   # chunk number -> bytearray, least recently used first
+        self.changed = {}            # chunk number -> bytearray, for chunks written
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Bytes of chunk c of the raw image (the last chunk may be short)
+    def _chunk(self, c):
+        if c in self.changed: return self.changed[c]
+        if c in self.cache:
+            ba = self.cache.pop(c)
+        else:
+            pos, n = self.index[c]
+            length = min(self.chunk_bytes, self.size - c * self.chunk_bytes)
+            if n == 0:
+                ba = bytearray(length)
+            else:
+                self.fil.seek(pos)
+                ba = bytearray(decompress_chunk(self.codec, self.fil.read(n)))
+                if len(ba) != length:
+                    raise Exception("Compressed image " + self.name + " has a bad chunk " + str(c))
+        self.cache[c] = ba     # now most recently used
+        while len(self.cache) > COMPRESSED_CACHE_CHUNKS: self.cache.popitem(last=False)
+        return ba
+
+    def seek(self, pos, whence=0):
+        self.pos = pos + (self.pos if whence == 1 else self.size if whence == 2 else 0)
+
+    def tell(self):
+        return self.pos
+
+    def fileno(self):
+        return self.fil.fileno()
+
+    def read(self, n=-1):
+        if n < 0: n = self.size - self.pos
+        n = max(0, min(n, self.size - self.pos))
+        result = bytearray()
+        while n > 0:
+            c, off = divmod(self.pos, self.chunk_bytes)
+            part = self._chunk(c)[off : off + n]
+            result += part
+            self.pos += len(part)
+            n -= len(part)
+        return bytes(result)
+
+    def write(self, data):
+        if not self.writable:
+            raise Exception("Compressed image " + self.name + " is open only for reading.")
+        if self.pos + len(data) > self.size:
+            raise Exception("Cannot write beyond the end of compressed image " + self.name)
+        done = 0
+        while done < len(data):
+            c, off = divmod(self.pos, self.chunk_bytes)
+            if c not in self.changed:
+                self.changed[c] = self._chunk(c)
+                self.cache.pop(c, None)
+            ba = self.changed[c]
+            part = data[done : done + len(ba) - off]
+            ba[off : off + len(part)] = part
+            self.pos += len(part)
+            done += len(part)
+
+    # Rewrite the file if chunks have been written: changed chunks are compressed again,
+    # others are copied without decompressing them
+    def close(self):
+        if self.fil is None: return
+        if len(self.changed) > 0:
+            tmp_filename = self.name + ".tmp"
+            with open(tmp_filename, "wb") as out:
+                writer = CompressedWriter(out, self.ext, self.sec_bytes, self.n_sectors,
+                                          self.chunk_sectors, self.codec)
+                for c in range(len(self.index)):
+                    if c in self.changed:
+                        writer.add_chunk(self.changed[c])
+                    else:
+                        pos, n = self.index[c]
+                        self.fil.seek(pos)
+                        writer.add_compressed(self.fil.read(n))
+                writer.finish()
+            self.fil.close()
+            getattr(os, 'replace', os.rename)(tmp_filename, self.name)
+        else:
+            self.fil.close()
+        self.fil = None
+        self.changed = {}
+
+# Writes a compressed image file a chunk at a time
+class CompressedWriter:
+
+    def __init__(self, out, ext, sec_bytes, n_sectors, chunk_sectors, codec):
+        self.out = out
+        self.codec = codec
+        self.index = []
+        out.write(COMPRESSED_MAGIC)
+        out.write(struct.pack(COMPRESSED_HEADER, ext.encode('ascii'), sec_bytes, n_sectors, chunk_sectors, codec))
+
+    def add_chunk(self, data):
+        if data.count(b"\0") == len(data):
+            self.add_compressed(b"")      # empty run
+        else:
+            self.add_compressed(compress_chunk(self.codec, data))
+
+    def add_compressed(self, data):
+        self.index.append((self.out.tell(), len(data)))
+        self.out.write(data)
+
+    def finish(self):
+        index_pos = self.out.tell()
+        for pos, n in self.index:
+            self.out.write(struct.pack("<QI", pos, n))
+        self.out.write(struct.pack("<Q", index_pos))
+
+def compress_chunk(codec, data):
+    if codec == 1: return lzma.compress(bytes(data))
+    return zlib.compress(bytes(data), 9)
+
+def decompress_chunk(codec, data):
+    if codec == 1:
+        if lzma is None: raise Exception("This Python cannot read lzma-compressed images.")
+        return lzma.decompress(data)
+    return zlib.decompress(data)
+
+# Write a compressed image file from a raw disk image, reading the raw image a chunk at a time
+def compress_image(raw_filename, fullfilename, codec='zlib'):
+    if codec not in COMPRESSED_CODECS:
+        raise Exception("Compression must be one of " + " ".join(COMPRESSED_CODECS))
+    if codec == 'lzma' and lzma is None:
+        raise Exception("This Python has no lzma module.")
+    if os.path.splitext(fullfilename)[1].lower() != COMPRESSED_EXT:
+        raise Exception("Compressed image name " + fullfilename + " must end in " + COMPRESSED_EXT)
+    d = None
+    if os.path.splitext(raw_filename)[1].lower() not in (COMPRESSED_EXT, OVERLAY_EXT):
+        d = Disk.select(raw_filename)
+    if d is None:
+        raise Exception("File " + raw_filename + " is not a raw disk image.")
+    n_sectors = os.path.getsize(raw_filename) // d.sec_bytes
+    with open(raw_filename, "rb") as raw, open(fullfilename, "wb") as out:
+        writer = CompressedWriter(out, os.path.splitext(raw_filename)[1].lower(), d.sec_bytes,
+                                  n_sectors, COMPRESSED_CHUNK_SECTORS, COMPRESSED_CODECS.index(codec))
+        for c in range((n_sectors + COMPRESSED_CHUNK_SECTORS - 1) // COMPRESSED_CHUNK_SECTORS):
+            writer.add_chunk(raw.read(COMPRESSED_CHUNK_SECTORS * d.sec_bytes))
+        writer.finish()
+
+# Write a raw disk image from a compressed one, a chunk at a time
+def expand_image(fullfilename, raw_filename):
+    with CompressedImage(fullfilename) as img:
+        if os.path.splitext(raw_filename)[1].lower() != img.ext:
+            raise Exception("Compressed image " + fullfilename + " holds a " + img.ext + " image.")
+        with open(raw_filename, "wb") as raw:
+            for c in range(len(img.index)):
+                raw.write(img._chunk(c))
+
+# Extension and length in bytes of the raw disk image in a file, which may be compressed
+def image_shape(fullfilename):
+    ext = os.path.splitext(fullfilename)[1].lower()
+    if ext != COMPRESSED_EXT: return ext, os.path.getsize(fullfilename)
+    with CompressedImage(fullfilename) as img:
+        return img.ext, img.size
+
+# Open a disk image file, raw or compressed, for reading ("rb") or updating ("r+b")
+def open_image(fullfilename, mode="rb"):
+    if os.path.splitext(fullfilename)[1].lower() == COMPRESSED_EXT:
+        return CompressedImage(fullfilename, mode)
+    return open(fullfilename, mode)
+
+# Advisory lock on an open image file: shared while sectors are read, exclusive while
+# they are written, so programs that also lock the image never see half-written sectors.
+# Does nothing where the os has no flock.
+class ImageLock:
+
+    def __init__(self, fil, exclusive=False):
+        self.fil = fil
+        self.exclusive = exclusive
+
+    def __enter__(self):
+        if fcntl is not None:
+            fcntl.flock(self.fil.fileno(), fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        return self.fil
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            if self.exclusive and hasattr(self.fil, 'flush'): self.fil.flush()
+            fcntl.flock(self.fil.fileno(), fcntl.LOCK_UN)
+
 ## ********************************************************************************************************
 ##        CLASS DISK
 ## ********************************************************************************************************
@@ -224,27 +571,36 @@ class Disk (Indexed_IO):
     function like one disk, they are treated as one disk object."""
 
     # Select a disk based on the size of the .dsk file
+    # An overlay file selects the disk image at the bottom of its stack
     @classmethod
     def select(cls, fullfilename):
-        word_len = os.path.getsize(fullfilename)//2
-        ext = os.path.splitext(fullfilename)[1].lower()
+        overlay = None
+        if os.path.splitext(fullfilename)[1].lower() == OVERLAY_EXT:
+            overlay = Overlay(fullfilename)
+            fullfilename = overlay.image_filename
+        ext, length = image_shape(fullfilename)
+        word_len = length//2
         if Diablo.is_file_right(ext, word_len):
-            return Diablo(fullfilename)
+            return Diablo(fullfilename, overlay)
         if Trident.is_file_right(ext, word_len):
-            return Trident(fullfilename)
+            return Trident(fullfilename, overlay)
         return None
 
     # Attributes that subclasses must have
     # nSectors, nHeads, nCylinders, nDrives
     # DH_len, DL_len, DD_len (length of header, label, data blocks in words)
 
-    def __init__(self, fullfilename):
+    def __init__(self, fullfilename, overlay=None):
         self.disk = self   # so Indexec_IO can find us
         self.fullfilename = fullfilename
+        self.overlay = overlay   # if not None, changed sectors are written here, not to the image
         self.dirty = False    # not written yet
+        self.read_only = False   # if True, changing a sector raises an exception
+        self.label_index = None  # LabelIndex, if one has been built
 
         # total sector length
         self.DBLK_len = self.DH_len + self.DL_len + self.DD_len
+        self.sec_bytes = (self.DBLK_len + DSK_FILE_SEC_HEADER)*2   # in the image file
         # get_word: word offsets in bytearray to get to appropriate block
         self.DH_base = - self.DL_len - self.DH_len
         self.DL_base = - self.DL_len
@@ -252,6 +608,8 @@ class Disk (Indexed_IO):
 
         # These are defined dynamically because they depend on disk properties
         self.LD_offset = -self.DD_len
+        self.LD_created = self.LD_offset + 0   # two-word times
+        self.LD_written = self.LD_offset + 2
         self.LD_name = self.LD_offset + 6
         self.LD_property = self.LD_offset + 246  # beginning index, length
         self.LD_bits = self.LD_offset + 247   # consecutive hint is sign bit
@@ -259,7 +617,7 @@ class Disk (Indexed_IO):
         self.LD_hintLastPageFa = self.LD_offset + 253
 
     def is_file_size_right(self):
-        file_word_len = os.path.getsize(self.fullfilename)//2
+        file_word_len = image_shape(self.fullfilename)[1]//2
         file_sec_count = file_word_len // (self.DBLK_len + DSK_FILE_SEC_HEADER)
         self.nVDAs = self.nDisks * self.nTracks * self.nHeads * self.nSectors
         return file_sec_count == self.nVDAs
@@ -288,12 +646,108 @@ class Disk (Indexed_IO):
         # Actually print it
         pr(s)
 
+    # Property of a page from its label: 'next' (DA), 'numChars', 'pageNumber', 'FID'
+    # Uses the label index if there is one
+    def get_sec_property(self, vda, prop_name):
+        if self.label_index is not None:
+            return self.label_index.get_sec_property(vda, prop_name)
+        return self._label_property(vda, prop_name)
+
+    # Write a free label (all zero except FID = -1) in one step
+    def clear_label(self, vda):
+        label = bytearray(self.DL_len*2)
+        for i in (self.DL_FID_version, self.DL_FID_SN, self.DL_FID_SN+1):
+            label[(i - self.DL_base)*2 : (i - self.DL_base + 1)*2] = b"\xff\xff"
+        label_start = (DSK_FILE_SEC_HEADER + self.DH_len)*2
+        ba, base = self._sector(vda, True)
+        ba[base + label_start : base + label_start + self.DL_len*2] = label
+
+    # Contents of a sector (header, label and data) as a new bytearray; changing it
+    # does not change the disk
+    def _get_ba(self, vda):
+        ba, base = self._sector(vda)
+        return ba[base : base + self.sec_bytes]
+
+    # List the vdas whose sectors (header, label and data) differ from those of another
+    # disk of the same shape.  Blocks of sectors, as read from the images, are compared
+    # whole; sectors are compared one by one only in blocks that differ.
+    def changed_vdas(self, other):
+        if (other.DBLK_len, other.nVDAs) != (self.DBLK_len, self.nVDAs):
+            raise Exception("Disks " + self.fullfilename + " and " + other.fullfilename + " have different shapes.")
+        changed = []
+        for first in range(0, self.nVDAs, self.block_sectors):
+            end = min(first + self.block_sectors, self.nVDAs)
+            if self._sectors(first, end) == other._sectors(first, end): continue
+            changed.extend(vda for vda in range(first, end) if self._get_ba(vda) != other._get_ba(vda))
+        return changed
+
+    # Merge the top overlay into the layer beneath it (another overlay or the disk image),
+    # then delete it.  Writes the disk; the disk should not be used afterwards.
+    def flatten_overlay(self):
+        top = self.overlay
+        if top is None:
+            raise Exception("Disk " + self.fullfilename + " has no overlay to flatten.")
+        self.flush()    # changes made so far go into the top overlay
+        self.overlay = top.base
+        self._overlay_removed()
+        for vda in top.index:
+            ba, base = self._sector(vda, True)
+            ba[base : base + self.sec_bytes] = top.get(vda)
+        self.write_disk()
+        top.remove()
+
+    # Called when the top overlay is removed; sectors in the overlays left are not read
+    # from the image
+    def _overlay_removed(self):
+        self.overlay_vdas = self.overlay.vdas() if self.overlay is not None else set()
+
+    # Image files of the disk, whose changes by other programs refresh looks for
+    def image_filenames(self):
+        return [self.fullfilename]
+
+    # Modification time and size of each image file
+    def _image_stamp(self):
+        stamp = []
+        for fn in self.image_filenames():
+            st = os.stat(fn)
+            stamp.append((st.st_mtime, st.st_size))
+        return stamp
+
+    # Called after this disk has written its image files, so that refresh does not take
+    # the change for another program's.  A change made by another program before ours
+    # still shows, since the stamp is then already out of date.
+    def _wrote_image(self, stamp):
+        if stamp == self.stamp: self.stamp = self._image_stamp()
+
+    # Reload the sectors that another program (such as an emulator) changed in the image
+    # files since they were read.  Unless force, looks only if a file's modification time
+    # or size changed; then only the regions whose checksums changed are compared sector by
+    # sector.  Sectors held in overlays are not affected.  Returns the vdas that changed.
+    def refresh(self, force=False):
+        stamp = self._image_stamp()
+        if stamp == self.stamp and not force: return []
+        changed = self._reload_changed()
+        self.stamp = stamp
+        if self.label_index is not None: self.label_index.stale.update(changed)
+        return changed
+
+    def _read_only_error(self):
+        raise Exception("Disk image " + self.fullfilename + " is open only for reading.")
+
+    # Raised by _reload_changed when a changed region holds sectors not yet written
+    def _conflict(self, fn):
+        raise Exception("Disk image " + fn + " was changed by another program while it had changes not yet written.")
+
     def vda_verify(self, vda):
         da = self.VDA_to_DA(vda)
         prr("VDA verify: ",vda,"=> ",da,strstr(da))
         vda = self.DA_to_VDA(da)
         prr("   and backL :",vda)
 
+# Diablo images are read DIABLO_READ_TRACKS tracks at a time, as sectors are first used,
+# so a command reads only the parts of the image it needs
+DIABLO_READ_TRACKS = 8
+
 class Diablo(Disk):
 
     @classmethod
@@ -305,7 +759,7 @@ class Diablo(Disk):
         if nTracks == 203 or nTracks == 406 or nTracks == 812: return True
         return False
 
-    def __init__(self, fullfilename):
+    def __init__(self, fullfilename, overlay=None):
 
         # Sector size parameters
         self.DH_len = 2
@@ -318,8 +772,9 @@ class Diablo(Disk):
         self.nDisks = 1      # may be changed
 
         # This call is placed here in order to compute other disk attributes
-        Disk.__init__(self, fullfilename)
+        Disk.__init__(self, fullfilename, overlay)
         self.fullfilename2 = None   # one-disk system
+        self.dirty_vdas = set()     # sectors changed, written to an overlay
 
         # word offsets and lengths in DL
         self.DL_next = self.DL_base + 0
@@ -344,11 +799,16 @@ class Diablo(Disk):
         # Note: nDisks may not be right -- DiskDescriptor may call for 2 disks
         # even though file records only one
 
-        self.sectors = []  # holds bytearray for the sectors of the disk
-        dsk_fil = open(self.fullfilename, "rb")
-        for i in range(self.nVDAs):
-            contents = bytearray(dsk_fil.read((self.DBLK_len + DSK_FILE_SEC_HEADER)*2))
-            self.sectors.append(contents)
+        # The whole image, sectors in vda order, in one buffer.  It is read from the file
+        # DIABLO_READ_TRACKS tracks at a time, when a sector in them is first used.
+        self.image = bytearray(self.nVDAs * self.sec_bytes)
+        self.chunk_sectors = DIABLO_READ_TRACKS * self.nSectors
+        self.block_sectors = self.chunk_sectors     # compared at once by changed_vdas
+        self.loaded = bytearray((self.nVDAs + self.chunk_sectors - 1) // self.chunk_sectors)
+        self.drive_vdas = self.nVDAs    # vdas in each drive's image file
+        self.chunk_crcs = {}            # chunk number -> crc32 of the chunk as read from the files
+        self._overlay_removed()
+        self.stamp = self._image_stamp()
 
         #prr("Final disk shape: nDisks",self.nDisks,"nTracks",self.nTracks,"nHeads",self.nHeads,"nSectors",self.nSectors)
 
@@ -361,36 +821,125 @@ class Diablo(Disk):
         self.fullfilename2 = parts[0] + "1" + parts[2]
         # read in the same number of VDAs as for the first disk
         prr("Reading",self.fullfilename2,"to form a 2-disk file system.")
-        dsk_fil = open(self.fullfilename2, "rb")
-        for i in range(self.nVDAs):
-            contents = bytearray(dsk_fil.read((self.DBLK_len + DSK_FILE_SEC_HEADER)*2))
-            self.sectors.append(contents)
+        if not os.path.exists(self.fullfilename2):
+            raise Exception("Cannot find " + self.fullfilename2 + " for a 2-disk file system.")
+        self.image += bytearray(self.nVDAs * self.sec_bytes)
         # and bump the number of vdas
         self.nVDAs *= 2
+        n_chunks = (self.nVDAs + self.chunk_sectors - 1) // self.chunk_sectors
+        self.loaded += bytearray(n_chunks - len(self.loaded))
+        # a chunk already read may run on into the second drive
+        c = (self.drive_vdas - 1) // self.chunk_sectors
+        if self.loaded[c]:
+            self._read_sectors(self.drive_vdas, min((c+1) * self.chunk_sectors, self.nVDAs))
+            self.chunk_crcs.pop(c, None)    # refresh compares its sectors one by one
         self.nDisks = 2
+        self.stamp = self._image_stamp()
 
         # DEBUG
         #disk.print_sector(self.nVDAs//2)
         #disk.print_sector((self.nVDAs//2)+1)
 
-    # Write out current disk as a new disk image
+    def image_filenames(self):
+        if self.fullfilename2 is None: return [self.fullfilename]
+        return [self.fullfilename, self.fullfilename2]
+
+    # Read chunk number c of the image
+    def _load(self, c):
+        first = c * self.chunk_sectors
+        self.chunk_crcs[c] = zlib.crc32(self._read_sectors(first, min(first + self.chunk_sectors, self.nVDAs)))
+        self.loaded[c] = 1
+
+    # Read sectors first..end-1 of the image (from one or both drives' files), then
+    # replace those held in the overlays.  Returns the sectors as read from the files.
+    def _read_sectors(self, first, end):
+        data = self._read_raw(first, end)
+        self.image[first * self.sec_bytes : end * self.sec_bytes] = data
+        for vda in self.overlay_vdas:
+            if first <= vda < end:
+                self.image[vda*self.sec_bytes : (vda+1)*self.sec_bytes] = self.overlay.get(vda)
+        return data
+
+    # Sectors first..end-1 as the disk holds them, in vda order
+    def _sectors(self, first, end):
+        for c in range(first // self.chunk_sectors, (end - 1) // self.chunk_sectors + 1):
+            if not self.loaded[c]: self._load(c)
+        return self.image[first * self.sec_bytes : end * self.sec_bytes]
+
+    # Sectors first..end-1 as they are in the image files
+    def _read_raw(self, first, end):
+        parts = []
+        vda = first
+        while vda < end:
+            drive = vda // self.drive_vdas
+            n = min(end, (drive+1) * self.drive_vdas) - vda
+            with open_image(self.fullfilename2 if drive == 1 else self.fullfilename) as dsk_fil:
+                with ImageLock(dsk_fil):
+                    dsk_fil.seek((vda - drive * self.drive_vdas) * self.sec_bytes)
+                    data = dsk_fil.read(n * self.sec_bytes)
+            if len(data) != n * self.sec_bytes:
+                raise Exception("Disk image " + dsk_fil.name + " is too short.")
+            parts.append(bytes(data))    # compressed images read as bytearrays
+            vda += n
+        return b''.join(parts)
+
+    # Compare the chunks read so far with the image files, copying in sectors that changed
+    def _reload_changed(self):
+        changed = []
+        sb = self.sec_bytes
+        dirty_chunks = set(vda // self.chunk_sectors for vda in self.dirty_vdas)
+        for c in range(len(self.loaded)):
+            if not self.loaded[c]: continue
+            first = c * self.chunk_sectors
+            end = min(first + self.chunk_sectors, self.nVDAs)
+            data = self._read_raw(first, end)
+            crc = zlib.crc32(data)
+            if self.chunk_crcs.get(c) == crc: continue
+            if c in dirty_chunks and self.overlay is None:
+                self._conflict(self.fullfilename)
+            for vda in range(first, end):
+                if vda in self.overlay_vdas or vda in self.dirty_vdas: continue
+                sector = data[(vda - first) * sb : (vda - first + 1) * sb]
+                if self.image[vda * sb : (vda+1) * sb] != sector:
+                    self.image[vda * sb : (vda+1) * sb] = sector
+                    changed.append(vda)
+            self.chunk_crcs[c] = crc
+        return changed
+
+    # Write changed sectors to the overlay, or in place in the image files
+    def flush(self):
+        vdas = sorted(self.dirty_vdas)
+        self.dirty_vdas = set()
+        if self.overlay is not None:
+            for vda in vdas:
+                self.overlay.put(vda, self._get_ba(vda))
+            return
+        if len(vdas) == 0: return
+        stamp = self._image_stamp()
+        for drive, fn in ((0, self.fullfilename), (1, self.fullfilename2)):
+            runs = vda_runs([vda - drive * self.drive_vdas for vda in vdas
+                             if vda // self.drive_vdas == drive])
+            if len(runs) == 0: continue
+            with open_image(fn, "r+b") as f:
+                with ImageLock(f, True):
+                    for first, n in runs:
+                        f.seek(first * self.sec_bytes)
+                        start = (first + drive * self.drive_vdas) * self.sec_bytes
+                        f.write(self.image[start : start + n * self.sec_bytes])
+                f.close()
+        # the chunks written now match the files
+        for c in set(vda // self.chunk_sectors for vda in vdas):
+            first = c * self.chunk_sectors
+            end = min(first + self.chunk_sectors, self.nVDAs)
+            self.chunk_crcs[c] = zlib.crc32(bytes(self.image[first * self.sec_bytes : end * self.sec_bytes]))
+        self._wrote_image(stamp)
+
+    # Write the changed sectors: to the overlay if there is one, otherwise to the image
     def write_disk(self):
-        if not self.dirty: return
-        write_nVDAs = self.nVDAs
-        if self.fullfilename2 is not None: write_nVDAs = self.nVDAs//2
-        # write first disk
-        with open(self.fullfilename, "wb") as f:
-            for vda in range(write_nVDAs):
-                f.write(self.sectors[vda])
-            f.close()
-        if self.fullfilename2 is None: return
-        # write second disk
-        with open(self.fullfilename2, "wb") as f:
-            for vda in range(write_nVDAs):
-                f.write(self.sectors[vda + write_nVDAs])
-            f.close()
+        self.flush()
+        self.dirty = False
 
-    def get_sec_property(self, vda, prop_name):
+    def _label_property(self, vda, prop_name):
         offset = {'next': self.DL_next, 'numChars': self.DL_numChars, 'pageNumber': self.DL_pageNumber, 'FID': 2000}[prop_name]
         if offset < 2000: return self.get_word(offset, vda=vda)
         # multi-word entries
@@ -399,9 +948,14 @@ class Diablo(Disk):
                 self.get_word(self.DL_FID_SN, vda=vda),
                 self.get_word(self.DL_FID_SN+1, vda=vda))
 
-    def _get_ba(self, vda, dirty=False):
-        if dirty: self.dirty = True
-        return self.sectors[vda]
+    def _sector(self, vda, dirty=False):
+        if not self.loaded[vda // self.chunk_sectors]: self._load(vda // self.chunk_sectors)
+        if dirty:
+            if self.read_only: self._read_only_error()
+            self.dirty = True
+            self.dirty_vdas.add(vda)
+            if self.label_index is not None: self.label_index.stale.add(vda)
+        return self.image, vda * self.sec_bytes
 
     # Convert VDA to DA
     def VDA_to_DA(self, vda):
@@ -433,18 +987,26 @@ class Diablo(Disk):
     def set_DA(self, idx, da, vda):
         self.set_word(idx, da, vda=vda)
 
+# Trident images differ only in the number of heads; the extension tells which drive
+TRIDENT_HEADS = {'.dsk80': 5, '.dsk300': 19}
+
+# Trident images are read a few tracks at a time into a cache of sectors, rather
+# than one seek/read per sector.  A track is nSectors consecutive sectors in the file.
+TRIDENT_READ_TRACKS = 8        # tracks read per access to the image file
+TRIDENT_CACHE_SECTORS = 1024   # sectors held in the cache (about 2MB)
+TRIDENT_MAX_VDAS = 1 << 16     # sectors a 16-bit VDA can name
+
 class Trident(Disk):
 
     @classmethod
     def is_file_right(cls, ext, word_len):
-        if ext != '.dsk80': return False
+        if ext not in TRIDENT_HEADS: return False
         sec_len = 2 + 10 + 1024 + DSK_FILE_SEC_HEADER     # see below for same disk config
         if word_len % sec_len != 0: return False
         nHeads = word_len // (sec_len * 9 * 815)
-        if nHeads == 5: return True                       # code does not handle T300
-        return False
+        return nHeads == TRIDENT_HEADS[ext]
 
-    def __init__(self, fullfilename):
+    def __init__(self, fullfilename, overlay=None):
 
         # Sector size parameters
         self.DH_len = 2
@@ -457,7 +1019,7 @@ class Trident(Disk):
         self.nDisks = 1
 
         # This call is placed here in order to compute other disk attributes
-        Disk.__init__(self, fullfilename)
+        Disk.__init__(self, fullfilename, overlay)
 
         # word offsets and lengths in DL
         self.DL_next = self.DL_base + 8
@@ -475,13 +1037,25 @@ class Trident(Disk):
 
         for config in (5, 19, -1):
             if config == -1:
-                raise Exception("File size not right for Diablo disk configurations.")
+                raise Exception("File size not right for Trident disk configurations.")
             self.nHeads = config
             if self.is_file_size_right(): break
-
-        self.dsk_fil = open(self.fullfilename, "r+b")  # read,write
-        self.vda_in_buffer = -1
-        self.vda_dirty = False
+        # nVDAs may be reduced by the DiskDescriptor: a T300 has more sectors than
+        # 16-bit VDAs can name, so its file system covers only some of the tracks
+        self.nSlots = self.nVDAs     # sectors in the image file
+
+        # opened for writing only when a sector is first written to it
+        self.dsk_fil = open_image(self.fullfilename, "rb")
+        self.dsk_writable = False
+        self.cache = OrderedDict()   # vda -> bytearray, least recently used first
+        self.cache_dirty = set()     # vdas in cache that must be written back
+        self.vda_in_buffer = -1      # most recently used sector, skips cache bookkeeping
+        self.vda_buffer = None
+        self.block_sectors = TRIDENT_READ_TRACKS * self.nSectors   # read at once
+        self.group_bytes = self.block_sectors * self.sec_bytes
+        self._overlay_removed()
+        self.group_crcs = {}         # file position of each read -> crc32 as read, None if since written
+        self.stamp = self._image_stamp()
 
         #prr("Final disk shape: nDisks",self.nDisks,"nTracks",self.nTracks,"nHeads",self.nHeads,"nSectors",self.nSectors)
 
@@ -489,13 +1063,67 @@ class Trident(Disk):
     def add_second_drive(self):
         pass
 
+    # DiskDescriptor found that the file system uses only the first nVTracks tracks.
+    # Only the file system at the start of the pack is handled: it is the one whose SysDir
+    # and DiskDescriptor are found at vdas 1 and up, before the tracks are known.
+    def set_file_system_tracks(self, firstVTrack, nVTracks):
+        if firstVTrack != 0:
+            raise Exception("File system starts at track " + str(firstVTrack) +
+                            "; AFU handles only the file system at the start of the pack.")
+        if nVTracks * self.nSectors > min(self.nSlots, TRIDENT_MAX_VDAS):
+            raise Exception("Bad file system tracks: first "+str(firstVTrack)+" number "+str(nVTracks))
+        self.nVDAs = nVTracks * self.nSectors
+
+    # DiskDescriptor gave no file system tracks, so the file system covers the whole pack
+    def check_file_system_size(self):
+        if self.nVDAs > TRIDENT_MAX_VDAS:
+            raise Exception("Disk " + self.fullfilename + " has " + str(self.nVDAs) +
+                            " sectors, more than 16-bit VDAs can name, and its DiskDescriptor gives no nVTracks.")
+
+    # Does nothing once the image is closed, as after flatten_overlay
     def write_disk(self):
+        if self.dsk_fil is None: return
         # make sure any buffered writes are done
-        self._get_in_buffer(0)
-        self._get_in_buffer(1)
+        self.flush()
         self.dsk_fil.close()
-
-    def get_sec_property(self, vda, prop_name):
+        self.dsk_fil = None
+        if self.overlay is not None: self.overlay.close()
+
+    # Reopen the image for writing, the first time a sector is written to it
+    def _open_for_writing(self):
+        if not self.dsk_writable:
+            self.dsk_fil.close()
+            self.dsk_fil = open_image(self.fullfilename, "r+b")
+            self.dsk_writable = True
+
+    # Write all modified sectors, in file order, combining adjacent sectors into one write
+    def flush(self):
+        if self.overlay is not None:
+            for vda in sorted(self.cache_dirty):
+                self.overlay.put(vda, self.cache[vda])
+            self.overlay_vdas |= self.cache_dirty
+            self.cache_dirty = set()
+            return
+        if len(self.cache_dirty) > 0: self._open_for_writing()
+        stamp = self._image_stamp()
+        slots = sorted((self._file_slot(vda), vda) for vda in self.cache_dirty)
+        i = 0
+        with ImageLock(self.dsk_fil, True):
+            while i < len(slots):
+                j = i + 1
+                while j < len(slots) and slots[j][0] == slots[j-1][0] + 1: j += 1
+                self.dsk_fil.seek(slots[i][0] * self.sec_bytes)
+                self.dsk_fil.write(b''.join(bytes(self.cache[vda]) for slot, vda in slots[i:j]))
+                i = j
+        for slot, vda in slots: self._group_written(slot)
+        self.cache_dirty = set()
+        if isinstance(self.dsk_fil, CompressedImage) and len(self.dsk_fil.changed) > 0:
+            # a compressed image is written when it is closed
+            self.dsk_fil.close()
+            self.dsk_fil = open_image(self.fullfilename, "r+b")
+        self._wrote_image(stamp)
+
+    def _label_property(self, vda, prop_name):
         offset = {'next': 2000, 'numChars': self.DL_numChars, 'pageNumber': self.DL_pageNumber, 'FID': 2001}[prop_name]
         if offset < 2000: return self.get_word(offset, vda=vda)
         # multi-word entries
@@ -508,39 +1136,146 @@ class Trident(Disk):
                 self.get_word(self.DL_FID_SN, vda=vda),
                 self.get_word(self.DL_FID_SN+1, vda=vda))
 
-    def _position_file_at_vda(self, vda):
+    # Position of a sector in the image file, in units of sectors
+    def _file_slot(self, vda):
         if VDA_FIX:
             but_sec = vda // 9
             sec = (vda+1) % 9   # permute sectors
             vda = (but_sec*9) + sec
-        pos = vda * (self.DBLK_len + DSK_FILE_SEC_HEADER)
-        self.dsk_fil.seek(pos*2)
-
-    def _get_in_buffer(self, vda):
-        if self.vda_dirty:
-            self._position_file_at_vda(self.vda_in_buffer)
-            self.dsk_fil.write(self.vda_buffer)
-        self._position_file_at_vda(vda)
-        self.vda_buffer = bytearray(self.dsk_fil.read((self.DBLK_len + DSK_FILE_SEC_HEADER)*2))
-        self.vda_in_buffer = vda
-        self.vda_dirty = False
-        # check to see if things are right
-        #self.print_sector(vda)
+        return vda
+
+    # Inverse of _file_slot: the vda stored at a position in the image file
+    def _slot_vda(self, slot):
         if VDA_FIX:
-            # get header from block just read
-            da = (self.get_word(self.DH_base, vda=vda),
-                  self.get_word(self.DH_base+1, vda=vda))
-            vda_read = self.DA_to_VDA(da)
-            if vda_read != vda:
-                self.print_sector(vda)
-                raise Exception("_get_in_buffer got wrong data "+str(da)+" "+str(vda))
-
-    def _get_ba(self, vda, dirty=False):
-        if vda != self.vda_in_buffer: self._get_in_buffer(vda)
+            return (slot // 9) * 9 + (slot - 1) % 9
+        return slot
+
+    # Read the TRIDENT_READ_TRACKS tracks holding vda; return vda's sector
+    # The sector permutation stays within a track, so whole tracks are contiguous in the file
+    def _read_tracks(self, vda):
+        pos = (self._file_slot(vda) * self.sec_bytes // self.group_bytes) * self.group_bytes
+        first = pos // self.sec_bytes
+        count = min(TRIDENT_READ_TRACKS * self.nSectors, self.nSlots - first)
+        with ImageLock(self.dsk_fil):
+            self.dsk_fil.seek(pos)
+            data = bytes(self.dsk_fil.read(count * self.sec_bytes))
+        if pos not in self.group_crcs: self.group_crcs[pos] = zlib.crc32(data)
+        result = None
+        for i in range(count):
+            v = self._slot_vda(first + i)
+            if v in self.cache: continue    # may hold changes not yet written
+            ba = bytearray(data[i*self.sec_bytes:(i+1)*self.sec_bytes])
+            if self.overlay is not None:
+                ba = self.overlay.get(v) or ba
+            if VDA_FIX:
+                # get header from block just read
+                da = (self._get_word_from_bytes(ba, DSK_FILE_SEC_HEADER),
+                      self._get_word_from_bytes(ba, DSK_FILE_SEC_HEADER+1))
+                try:
+                    vda_read = self.DA_to_VDA(da)
+                except Exception:
+                    vda_read = -1
+                if vda_read != v:
+                    if v != vda: continue   # complain only if someone asks for it
+                    self.cache[v] = ba
+                    self.print_sector(vda)
+                    del self.cache[v]
+                    self.vda_in_buffer = -1
+                    raise Exception("_get_in_buffer got wrong data "+str(da)+" "+str(vda))
+            self.cache[v] = ba
+            if v == vda: result = ba
+        if result is None: result = self.cache[vda]
+        self._trim_cache()
+        return result
+
+    # Drop least recently used sectors, writing them first if modified
+    def _trim_cache(self):
+        while len(self.cache) > TRIDENT_CACHE_SECTORS:
+            vda, ba = self.cache.popitem(last=False)
+            if vda in self.cache_dirty:
+                if self.overlay is not None:
+                    self.overlay.put(vda, ba)
+                    self.overlay_vdas.add(vda)
+                else:
+                    self._open_for_writing()
+                    stamp = self._image_stamp()
+                    with ImageLock(self.dsk_fil, True):
+                        self.dsk_fil.seek(self._file_slot(vda) * self.sec_bytes)
+                        self.dsk_fil.write(ba)
+                    self._group_written(self._file_slot(vda))
+                    self._wrote_image(stamp)
+                self.cache_dirty.discard(vda)
+            if vda == self.vda_in_buffer: self.vda_in_buffer = -1
+
+    # Sectors first..end-1 (whole tracks) as the disk holds them, in the order of the file;
+    # sectors not yet written back, or held in overlays, replace those read
+    def _sectors(self, first, end):
+        with ImageLock(self.dsk_fil):
+            self.dsk_fil.seek(first * self.sec_bytes)
+            data = self.dsk_fil.read((end - first) * self.sec_bytes)
+        vdas = set(range(first, end))
+        held = vdas.intersection(self.cache_dirty) | vdas.intersection(self.overlay_vdas)
+        if len(held) == 0: return data
+        data = bytearray(data)
+        for vda in held:
+            pos = (self._file_slot(vda) - first) * self.sec_bytes
+            data[pos : pos + self.sec_bytes] = self._get_ba(vda)
+        return data
+
+    # A sector at a position in the file has been written; refresh will compare its read
+    # group sector by sector
+    def _group_written(self, slot):
+        pos = (slot * self.sec_bytes // self.group_bytes) * self.group_bytes
+        if pos in self.group_crcs: self.group_crcs[pos] = None
+
+    # Compare the groups of tracks read so far with the image file.  Changed sectors in the
+    # cache are replaced; sectors no longer cached in a changed group are taken to have
+    # changed, as their old contents are not known.
+    def _reload_changed(self):
+        if isinstance(self.dsk_fil, CompressedImage):
+            # another program writes a new file; read that one
+            if len(self.dsk_fil.changed) > 0: self._conflict(self.fullfilename)
+            self.dsk_fil.close()
+            self.dsk_fil = open_image(self.fullfilename, "r+b" if self.dsk_writable else "rb")
+        changed = []
+        sb = self.sec_bytes
+        for pos in sorted(self.group_crcs):
+            first = pos // sb
+            count = min(TRIDENT_READ_TRACKS * self.nSectors, self.nSlots - first)
+            with ImageLock(self.dsk_fil):
+                self.dsk_fil.seek(pos)
+                data = bytes(self.dsk_fil.read(count * sb))
+            crc = zlib.crc32(data)
+            if crc == self.group_crcs[pos]: continue
+            vdas = [self._slot_vda(first + i) for i in range(count)]
+            if self.overlay is None and len(self.cache_dirty.intersection(vdas)) > 0:
+                self._conflict(self.fullfilename)
+            for i, vda in enumerate(vdas):
+                if vda in self.overlay_vdas or vda in self.cache_dirty or vda >= self.nVDAs: continue
+                sector = data[i*sb : (i+1)*sb]
+                if vda not in self.cache:
+                    changed.append(vda)
+                elif self.cache[vda] != sector:
+                    self.cache[vda][:] = sector    # in place: vda_buffer may be this sector
+                    changed.append(vda)
+            self.group_crcs[pos] = crc
+        return changed
+
+    def _sector(self, vda, dirty=False):
+        if vda != self.vda_in_buffer:
+            ba = self.cache.pop(vda, None)
+            if ba is None:
+                ba = self._read_tracks(vda)
+            else:
+                self.cache[vda] = ba     # now most recently used
+            self.vda_in_buffer = vda
+            self.vda_buffer = ba
         if dirty:
-            self.vda_dirty = True
+            if self.read_only: self._read_only_error()
+            self.cache_dirty.add(vda)
             self.dirty = True
-        return self.vda_buffer
+            if self.label_index is not None: self.label_index.stale.add(vda)
+        return self.vda_buffer, 0
 
     # Convert VDA to DA
     def VDA_to_DA(self, vda):
@@ -571,6 +1306,80 @@ class Trident(Disk):
         self.set_word(idx, da[0], vda=vda)
         self.set_word(idx+1, da[1], vda=vda)
 
+## ********************************************************************************************************
+##        CLASS LABEL INDEX
+## ********************************************************************************************************
+
+# A LabelIndex holds the label of every page on a disk, read in one pass in vda order
+# (sequentially through the image), in arrays indexed by vda.  next and previous are held
+# as vdas, -1 if the label's disk address is bad.  A page written after the index is built
+# is marked stale by the disk, and its label is decoded again when next asked for.
+
+class LabelIndex:
+
+    def __init__(self, disk):
+        self.disk = disk
+        self.label_start = (DSK_FILE_SEC_HEADER + disk.DH_len)*2   # bytes into sector
+        self.label_format = "<" + str(disk.DL_len) + "H"
+        self.version, self.sn0, self.sn1 = array('H'), array('H'), array('H')
+        self.pageNumber, self.numChars = array('H'), array('H')
+        self.next, self.previous = array('i'), array('i')
+        for vda in range(disk.nVDAs):
+            label = self._decode(vda)
+            for a, v in zip(self._arrays(), label): a.append(v)
+        self.stale = set()
+
+    def _arrays(self):
+        return (self.version, self.sn0, self.sn1, self.pageNumber, self.numChars, self.next, self.previous)
+
+    # Read a label; return values in the order of _arrays()
+    def _decode(self, vda):
+        disk = self.disk
+        ba, base = disk._sector(vda)
+        w = struct.unpack_from(self.label_format, ba, base + self.label_start)
+        def da_vda(i):
+            i -= disk.DL_base
+            da = w[i] if disk.DL_next_len == 1 else (w[i], w[i+1])
+            try:
+                return disk.DA_to_VDA(da)
+            except Exception:
+                return -1
+        return (w[disk.DL_FID_version - disk.DL_base], w[disk.DL_FID_SN - disk.DL_base],
+                w[disk.DL_FID_SN+1 - disk.DL_base], w[disk.DL_pageNumber - disk.DL_base],
+                w[disk.DL_numChars - disk.DL_base], da_vda(disk.DL_next), da_vda(disk.DL_previous))
+
+    # Decode labels of pages written since the index was built
+    def _refresh(self, vda):
+        if vda in self.stale:
+            for a, v in zip(self._arrays(), self._decode(vda)): a[vda] = v
+            self.stale.discard(vda)
+
+    # Same results as Disk.get_sec_property
+    def get_sec_property(self, vda, prop_name):
+        self._refresh(vda)
+        if prop_name == 'FID': return (self.version[vda], self.sn0[vda], self.sn1[vda])
+        if prop_name == 'pageNumber': return self.pageNumber[vda]
+        if prop_name == 'numChars': return self.numChars[vda]
+        if self.next[vda] == -1: return self.disk._label_property(vda, prop_name)
+        return self.disk.VDA_to_DA(self.next[vda])
+
+    # Follow the chain of pages from a leader page; return (vdas, numChars in all pages)
+    def chain(self, leader_vda):
+        vda = leader_vda
+        vdas = array('i', [vda])
+        numChars = 0
+        while True:
+            self._refresh(vda)
+            nx = self.next[vda]
+            numChars += self.numChars[vda]
+            if nx == 0: break
+            if nx == -1: raise Exception("Bad physical disk address")
+            if self.numChars[vda] != self.disk.DD_len*2:
+                prr("_index_file: numChars must be",self.disk.DD_len*2,"on non-terminal page")
+            vdas.append(nx)
+            vda = nx
+        return vdas, numChars
+
 ## ********************************************************************************************************
 ##        CLASS FILESYSTEM
 ## ********************************************************************************************************
@@ -601,7 +1410,13 @@ class FileSystem (Indexed_IO):
 
     # Init sets up directory, disk descriptor only on main call, not inits from subclasses
 
-    def __init__(self, disk):
+    # Attributes are kept in slots, here and in File and its subclasses, of which there
+    # may be many.  create_file uses file_vdas while it builds a file.
+    __slots__ = ('disk', 'directory', 'disk_descriptor', 'file_vdas')
+
+    # With verify, the DiskDescriptor's free page count is checked (and corrected) now,
+    # rather than before the first change to the bit table
+    def __init__(self, disk, verify=False):
         self.disk = disk
 
         # A file system has a disk descriptor and a directory, both opened as files and updated in place
@@ -609,6 +1424,7 @@ class FileSystem (Indexed_IO):
         #prr("Directory", self.directory)
         self.disk_descriptor = DiskDescriptor(self)
         #prr("Disk descriptor", self.disk_descriptor)
+        if verify: self.disk_descriptor.verify()
         # Not all disks will have Swatee; will be None if non-existent
         #self.swatee = self.file("Swatee.")
         #prr("Swatee", self.swatee)
@@ -616,6 +1432,24 @@ class FileSystem (Indexed_IO):
     def fsck(self):
         pass
 
+    # Take up changes another program made to the disk image since it was read (see
+    # Disk.refresh): SysDir and the DiskDescriptor are indexed again only if their pages
+    # changed.  Returns the set of vdas changed; File objects held elsewhere can be brought
+    # up to date with their refresh method.
+    def refresh(self, force=False):
+        changed = set(self.disk.refresh(force))
+        if len(changed) > 0:
+            self.directory.refresh(changed, self)
+            self.disk_descriptor.refresh(changed, self)
+        return changed
+
+    # Read every label on the disk in one pass.  From then on, files' chains and page
+    # properties come from the index rather than from reading labels sector by sector.
+    def build_label_index(self):
+        if self.disk.label_index is None:
+            self.disk.label_index = LabelIndex(self.disk)
+        return self.disk.label_index
+
 # Things to check
 # look for all leader pages (save vda, leadername, serial number)
 # make sure there's a SysDir. and a DiskDescriptor.
@@ -649,7 +1483,7 @@ class FileSystem (Indexed_IO):
         numChars = data_length + data_block_len * LEADER_ADJUST # includes file and leader page
 
         # first, allocate pages and write their new labels
-        self.file_vdas = []
+        self.file_vdas = array('i')
         for i in range((numChars + data_block_len) // data_block_len):  # number of pages
             self.file_vdas.append(self.disk_descriptor.allocate_page())
         # from here on, get_word and set_word see us as a "file" because self.file_vdas is valid
@@ -692,25 +1526,224 @@ class FileSystem (Indexed_IO):
         # return leader_vda
         return self.file_vdas[0]
 
-    # returns True if file existed and was deleted
-    def delete_file(self, nam):
-        # insure trailing .
+    # Write bytes s as the contents of file nam, creating the file if need be.  An existing
+    # file keeps its serial number, leader page and directory entry, and as many of its pages
+    # as the new length needs; pages are added or freed only at the end of the file, and
+    # only pages whose contents change are written.  Returns File object.
+    def write_file(self, nam, s):
         if nam[-1:] != '.': nam += '.'
         f = File(nam, self)
-        if not f.exists(): return False
-        #prr("Deleting file",nam,"vdas",f.file_vdas)
-        # found file
-        for p in f.file_vdas:
-            self.disk_descriptor.free_page(p)
-            # write label with FID set to -1
-            disk = self.disk
-            for i in range(disk.DL_base, disk.DL_base + disk.DL_len):
-                w = 0
-                if i in (disk.DL_FID_version, disk.DL_FID_SN, disk.DL_FID_SN+1): w = MINUS_ONE
-                self.set_word(i, w, vda=p)
-        # remove entry from directory
-        self.directory.remove(nam)
-        return True
+        if f.exists():
+            self._set_file_length(f, len(s))
+        else:
+            f = File(self.create_file(nam, len(s)), self)
+        f.write_bytes(s)
+        return f
+
+    # Change the length (in bytes) of a file by adding or freeing pages at its end
+    def _set_file_length(self, f, data_length):
+        disk = self.disk
+        dd = self.disk_descriptor
+        data_block_len = disk.DD_len*2   # bytes
+        numChars = data_length + data_block_len * LEADER_ADJUST # includes file and leader page
+        n_pages = (numChars + data_block_len) // data_block_len
+        vdas = f.file_vdas
+        old_n_pages = len(vdas)
+        if n_pages < old_n_pages:
+            for vda in vdas[n_pages:]: disk.clear_label(vda)
+            dd.free_pages(vdas[n_pages:])
+            del vdas[n_pages:]
+        while len(vdas) < n_pages:
+            vda = dd.allocate_page()
+            fid = disk.get_sec_property(vda, 'FID')
+            if fid != (MINUS_ONE, MINUS_ONE, MINUS_ONE):
+                prr("Deleted page has bad fileID", vda, fid)
+            vdas.append(vda)
+        # labels may change from the last page of the shorter version of the file onward;
+        # only words that differ are written, so an unchanged file changes no sectors
+        fid = disk.get_sec_property(f.leader_vda, 'FID')
+        da_zero = disk.VDA_to_DA(0)
+        for i in range(min(old_n_pages, n_pages) - 1, n_pages):
+            vda = vdas[i]
+            last = (i == n_pages-1)
+            for idx, da in ((disk.DL_next, da_zero if last else disk.VDA_to_DA(vdas[i+1])),
+                            (disk.DL_previous, disk.VDA_to_DA(vdas[i-1]))):
+                if disk.get_DA(idx, vda) != da: disk.set_DA(idx, da, vda)
+            for idx, w in ((disk.DL_numChars, data_block_len if not last else numChars-(n_pages-1)*data_block_len),
+                           (disk.DL_pageNumber, i), (disk.DL_FID_version, fid[0]),
+                           (disk.DL_FID_SN, fid[1]), (disk.DL_FID_SN+1, fid[2])):
+                if self.get_word(idx, vda) != w: self.set_word(idx, w, vda)
+        # leader page hints, written only if they change
+        hints = (vdas[-1], n_pages-1, numChars % data_block_len)
+        for i in range(len(hints)):
+            if f.get_word(disk.LD_hintLastPageFa+i) != hints[i]:
+                f.set_word(disk.LD_hintLastPageFa+i, hints[i])
+        f.length = data_length
+
+    # returns True if file existed and was deleted
+    def delete_file(self, nam):
+        return len(self.delete_files([nam])) > 0
+
+    # Delete all files matching any of a list of names or patterns; returns names deleted.
+    # One pass finds the files in the directory and another removes their entries; the
+    # bit table and free count are updated once for all pages.
+    # Delete the files matching any of a list of patterns.  SysDir and DiskDescriptor belong
+    # to the file system: patterns never match them, and naming one is an error.
+    def delete_files(self, patterns):
+        for pat in patterns:
+            if pat.lower().rstrip('.') + '.' in SYSTEM_FILES:
+                raise Exception("Cannot delete " + pat + ", it belongs to the file system")
+        entries = [(idx, e) for idx, e in self.directory._match_entries(patterns)
+                   if e['name'].lower() not in SYSTEM_FILES]
+        vdas = []
+        for idx, e in entries:
+            #prr("Deleting file",e['name'],"vdas",f.file_vdas)
+            vdas += File(e['leader_vda'], self).file_vdas
+        for vda in vdas:
+            self.disk.clear_label(vda)
+        self.disk_descriptor.free_pages(vdas)
+        # remove entries from directory
+        self.directory.remove_entries(set(idx for idx, e in entries))
+        return [e['name'] for idx, e in entries]
+
+    # Report on fragmentation of files, free space and SysDir; returns dict
+    def fragmentation(self):
+        report = {'files': 0, 'extents': 0, 'fragmented_files': 0}
+        for e in self.directory.list():
+            n = count_extents(File(e['leader_vda'], self).file_vdas)
+            report['files'] += 1
+            report['extents'] += n
+            if n > 1: report['fragmented_files'] += 1
+        runs = free_runs(self.disk_descriptor)
+        report['free_pages'] = sum(n for first, n in runs)
+        report['free_runs'] = len(runs)
+        report['largest_free_run'] = max([n for first, n in runs] + [0])
+        report.update(self.directory.usage())
+        return report
+
+    # Move file pages so that each file occupies consecutive vdas, packed from the start of
+    # the disk in directory order, then compact SysDir.  Files named in DEFRAG_PINNED, and the
+    # file whose pages follow the boot page (vda 0), are left where they are, because the
+    # Alto OS finds them by disk address.  Returns names of the files left in place.
+    def defragment(self):
+        disk = self.disk
+        dd = self.disk_descriptor
+        try:
+            boot_next = disk.DA_to_VDA(disk.get_DA(disk.DL_next, 0))
+        except Exception:
+            boot_next = -1   # the boot page leads nowhere on this disk; no file to leave in place
+        files = []    # (name, File) for files to be moved
+        pinned = []
+        in_files = set()
+        for e in self.directory.list():
+            f = File(e['leader_vda'], self)
+            in_files.update(f.file_vdas)
+            if e['name'].lower() in DEFRAG_PINNED or boot_next in f.file_vdas:
+                pinned.append(e['name'])
+            else:
+                files.append((e['name'], f))
+        # pages that files may be moved to: free pages, and those of the files being moved
+        movable = set()
+        for nam, f in files: movable.update(f.file_vdas)
+        for vda in range(1, dd.nVDAs):
+            if dd.is_page_free(vda) and vda not in in_files: movable.add(vda)
+        runs = vda_runs(sorted(movable))
+        # assign new vdas: first run big enough, else pages from the first runs
+        new_vdas = {}
+        for nam, f in files:
+            n = len(f.file_vdas)
+            fit = [i for i in range(len(runs)) if runs[i][1] >= n]
+            if len(fit) > 0:
+                first, length = runs[fit[0]]
+                new_vdas[nam] = array('i', range(first, first+n))
+                runs[fit[0]] = (first+n, length-n)
+            else:
+                new_vdas[nam] = array('i')
+                while len(new_vdas[nam]) < n:
+                    first, length = runs[0]
+                    take = min(length, n - len(new_vdas[nam]))
+                    new_vdas[nam].extend(range(first, first+take))
+                    runs[0] = (first+take, length-take)
+                    if runs[0][1] == 0: runs.pop(0)
+        # save labels and data of pages that move (headers belong to the sector, not the page)
+        label_start = (DSK_FILE_SEC_HEADER + disk.DH_len)*2
+        saved = {}
+        for nam, f in files:
+            for old, new in zip(f.file_vdas, new_vdas[nam]):
+                if old != new: saved[old] = disk._get_ba(old)[label_start:]
+        targets = set()
+        for nam in new_vdas: targets.update(new_vdas[nam])
+        # free the pages left behind
+        left = [vda for vda in saved if vda not in targets]
+        for vda in left: disk.clear_label(vda)
+        dd.free_pages(left)
+        # write the pages in their new places and relink them
+        leader_vdas = {}
+        da_zero = disk.VDA_to_DA(0)
+        for nam, f in files:
+            old_vdas, vdas = f.file_vdas, new_vdas[nam]
+            leader_vdas[f.leader_vda] = vdas[0]
+            if old_vdas == vdas: continue
+            for i in range(len(vdas)):
+                vda = vdas[i]
+                if old_vdas[i] != vda:
+                    if dd.is_page_free(vda): dd.set_page_bit(vda, 1, -1)
+                    ba, base = disk._sector(vda, True)
+                    ba[base + label_start : base + disk.sec_bytes] = saved[old_vdas[i]]
+                disk.set_DA(disk.DL_next, da_zero if i == len(vdas)-1 else disk.VDA_to_DA(vdas[i+1]), vda)
+                disk.set_DA(disk.DL_previous, da_zero if i == 0 else disk.VDA_to_DA(vdas[i-1]), vda)
+            self._fix_leader_hints(vdas[0], old_vdas[-1], vdas)
+        self.directory.compact(leader_vdas)
+        return pinned
+
+    # Update the leader page of a file that has moved to vdas
+    def _fix_leader_hints(self, leader_vda, old_last_vda, vdas):
+        disk = self.disk
+        lp = - disk.LD_offset    # index of leader page words when read by vda
+        hint = self.get_word(disk.LD_hintLastPageFa + lp, vda=leader_vda)
+        if hint == old_last_vda:
+            self.set_word(disk.LD_hintLastPageFa + lp, vdas[-1], vda=leader_vda)
+        elif isinstance(disk, Diablo) and hint == disk.VDA_to_DA(old_last_vda):
+            self.set_word(disk.LD_hintLastPageFa + lp, disk.VDA_to_DA(vdas[-1]), vda=leader_vda)
+        bits = self.get_word(disk.LD_bits + lp, vda=leader_vda)
+        if count_extents(vdas) == 1:
+            bits |= 0o100000
+        else:
+            bits &= 0o77777
+        self.set_word(disk.LD_bits + lp, bits, vda=leader_vda)
+
+# True if an Alto file name matches a pattern (as in fnmatch), ignoring case and final "."
+def name_matches(nam, pattern):
+    if pattern[-1:] != '.': pattern += '.'
+    if nam[-1:] != '.': nam += '.'
+    return fnmatch.fnmatchcase(nam.lower(), pattern.lower())
+
+# Files that make up the file system itself; they are never deleted or copied as files
+SYSTEM_FILES = ('sysdir.', 'diskdescriptor.')
+
+# Files the Alto OS finds by disk address rather than through SysDir; defragment leaves them alone
+DEFRAG_PINNED = ('sysdir.', 'diskdescriptor.', 'sys.boot.', 'swat.', 'swatee.', 'sysfont.al.')
+
+# Number of runs of consecutive vdas in a list of vdas (e.g., a file's pages)
+def count_extents(vdas):
+    n = 1 if len(vdas) > 0 else 0
+    for i in range(1, len(vdas)):
+        if vdas[i] != vdas[i-1] + 1: n += 1
+    return n
+
+# Runs of consecutive vdas in a sorted list, as (first vda, length)
+def vda_runs(vdas):
+    runs = []
+    for vda in vdas:
+        if len(runs) > 0 and runs[-1][0] + runs[-1][1] == vda:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((vda, 1))
+    return runs
+
+# Runs of free pages on the disk, as (first vda, length)
+def free_runs(disk_descriptor):
+    return vda_runs([vda for vda in range(disk_descriptor.nVDAs) if disk_descriptor.is_page_free(vda)])
 
 ## ********************************************************************************************************
 ##        CLASS FILE
@@ -721,6 +1754,8 @@ class File (FileSystem):
     in the file system.  You can tell if the file is good by testing leader_vda != -1
     """
 
+    __slots__ = ('leader_name', 'lookup_name', 'leader_vda', 'length')   # and disk, file_vdas
+
     def __init__(self, leader_vda, file_system):
         """Create file object: different wants to call
         leader_vda = vda of leader page
@@ -748,8 +1783,13 @@ class File (FileSystem):
     # Index the file, filling instance variables leader_name, length, file_vdas
     def _index_file(self):
         disk = self.disk
+        if disk.label_index is not None:
+            self.file_vdas, numChars = disk.label_index.chain(self.leader_vda)
+            self.leader_name = get_BCPL_string(lambda i: self.get_word(disk.LD_name+i))
+            self.length = numChars - disk.DD_len*2*LEADER_ADJUST
+            return
         vda = self.leader_vda
-        self.file_vdas = [ vda ]
+        self.file_vdas = array('i', [vda])
         numChars = 0  # total chars in file, counting leader
         while True:
             if vda == self.leader_vda: # leader page
@@ -765,10 +1805,72 @@ class File (FileSystem):
         # report file length WITHOUT leader page
         self.length = numChars - disk.DD_len*2*LEADER_ADJUST
 
+    # Index the file again if any of its pages are among the vdas changed (a set, from
+    # FileSystem.refresh).  A change to the chain always changes the label of a page
+    # already in it.  If the file is no longer in the directory (deleted, or renamed if it
+    # was looked up by name), it is marked as gone rather than indexed from pages that may
+    # now be free or another file's.  Returns whether the file changed.
+    def refresh(self, changed, file_system):
+        if changed.isdisjoint(self.file_vdas): return False
+        if self._in_directory(file_system):
+            self._index_file()
+        else:
+            self.leader_vda = -1
+            self.file_vdas = array('i')
+            self.length = 0
+        return True
+
+    # True if the directory has an entry for the file (under the name it was looked up
+    # by, if any) whose serial number matches the leader page's label
+    def _in_directory(self, file_system):
+        fid = self.disk.get_sec_property(self.leader_vda, 'FID')
+        name = getattr(self, 'lookup_name', None)
+        for e in file_system.directory.list(True):
+            if e['leader_vda'] == self.leader_vda and tuple(e['FP'][0:2]) == fid[1:] and \
+               (name is None or e['name'].lower() == name.lower()):
+                return True
+        return False
+
     # determine whether file exists (e.g., after a lookup)
     def exists(self):
         return self.leader_vda != -1
 
+    # Time the file was last written (or else created), from its leader page, as a Unix
+    # time; None if the leader page records neither
+    def written_time(self):
+        for idx in (self.disk.LD_written, self.disk.LD_created):
+            t = (self.get_word(idx) << 16) + self.get_word(idx+1)
+            if t != 0: return t - ALTO_TIME_OFFSET
+        return None
+
+    # return contents of the file (not the leader page) as a bytearray, reading whole pages
+    def read_bytes(self):
+        disk = self.disk
+        data_start = disk.index_offset*2
+        s = bytearray()
+        for vda in self.file_vdas[LEADER_ADJUST:]:
+            ba, base = disk._sector(vda)
+            s += ba[base + data_start : base + data_start + disk.DD_len*2]
+        swap_bytes(s)
+        del s[self.length:]
+        return s
+
+    # Write bytes s as the file's contents, a page at a time.  The file must already have
+    # the right length.  Only pages whose contents change are written.
+    def write_bytes(self, s):
+        disk = self.disk
+        data_block_len = disk.DD_len*2
+        data_start = disk.index_offset*2
+        for i in range(len(self.file_vdas) - LEADER_ADJUST):
+            page = bytearray(s[i*data_block_len : (i+1)*data_block_len])
+            page += bytearray(data_block_len - len(page))
+            swap_bytes(page)
+            vda = self.file_vdas[i + LEADER_ADJUST]
+            ba, base = disk._sector(vda)
+            if ba[base + data_start : base + data_start + data_block_len] != page:
+                ba, base = disk._sector(vda, True)
+                ba[base + data_start : base + data_start + data_block_len] = page
+
     # return (text) string for entire file
     def read_as_string(self):
         for ci in range(self.length):  # to numChars
@@ -782,7 +1884,7 @@ class File (FileSystem):
         s = "File: "
         s += self.leader_name
         if hasattr(self, 'file_vdas'):
-            s += " file_vdas" + str(self.file_vdas)
+            s += " file_vdas" + str(list(self.file_vdas))
         else:
             s += " [no vdas -- file does not exist]"
         return s
@@ -793,6 +1895,8 @@ class File (FileSystem):
 
 class DiskDescriptor (File):
 
+    __slots__ = ('nVDAs', 'bit_table_vdas', 'rover', 'verified')
+
     def __init__(self, file_system):
         File.__init__(self, "DiskDescriptor.", file_system)
         if self.leader_vda == -1: raise Exception("Cannot find DiskDescriptor.")
@@ -811,48 +1915,140 @@ class DiskDescriptor (File):
             s = ""
             for i in range(KDH_nDisks, KDH_nSectors+1): s += str(self.get_word(i))+" "
             raise Exception("DiskDescriptor format does not match config: "+s)
+        # Trident file systems may cover only some of the tracks (always so on a T300)
+        if isinstance(disk, Trident):
+            if self.get_word(KDH_nVTracks) != 0:
+                disk.set_file_system_tracks(self.get_word(KDH_firstVTrack), self.get_word(KDH_nVTracks))
+            else:
+                disk.check_file_system_size()
         # update to disk descriptor trugh
-        self.nVDAs = disk.nDisks * disk.nTracks * disk.nHeads * disk.nSectors
-        # check free page count, update if wrong
-        free_c = 0
-        # Check that bit table and free count agree
-        for vda in range(self.nVDAs):
-            if self.is_page_free(vda): free_c += 1
+        self.nVDAs = disk.nVDAs
+        self.bit_table_vdas = self._locate_bit_table()
+        self.rover = 0   # no free page below this vda
+        # The free page count is checked against the bit table by verify(), on the first
+        # change to the bit table, so that commands that only read never write the disk
+        self.verified = False
+
+    # Pages of the bit table changed by another program: find the bit table again, look for
+    # free pages from the lowest changed word, and check the free page count before the next change
+    def refresh(self, changed, file_system):
+        if changed.isdisjoint(self.file_vdas) and changed.isdisjoint(self.bit_table_vdas): return False
+        self._index_file()
+        self.bit_table_vdas = self._locate_bit_table()
+        for page, vda in enumerate(self.bit_table_vdas):
+            if vda in changed:
+                self.rover = min(self.rover, max(0, page * self.disk.DD_len - self.disk.KDH_bitTable) * 16)
+        self.verified = False
+        return True
+
+    # Check the free page count against the bit table, update it if wrong; return it
+    def verify(self):
+        self.verified = True
+        free_c = self.count_free_pages()
         if free_c != self.get_word(KDH_freePages):
             self.set_word(KDH_freePages, free_c)
             prr("DiskDescriptor free page count updated to", free_c)
+        return free_c
+
+    # Return list of vdas holding the data pages of the bit table, indexed by data page number.
+    # TFS records where the bit table is (KDH_VDAdiskDD: its pages are consecutive vdas);
+    # use that if the labels agree, otherwise follow the file.
+    def _locate_bit_table(self):
+        disk = self.disk
+        vdas = self.file_vdas[LEADER_ADJUST:]
+        if not isinstance(disk, Trident): return vdas
+        first_vda = self.get_word(KDH_VDAdiskDD)
+        fid = disk.get_sec_property(self.leader_vda, 'FID')
+        if not (0 < first_vda < self.nVDAs) or disk.get_sec_property(first_vda, 'FID') != fid:
+            return vdas
+        first_page = disk.get_sec_property(first_vda, 'pageNumber') - LEADER_ADJUST
+        last_page = (disk.KDH_bitTable + (self.nVDAs + 15) // 16 - 1) // disk.DD_len
+        located = list(vdas)
+        for page in range(first_page, last_page+1):
+            vda = first_vda + page - first_page
+            if page < 0 or page >= len(located) or vda >= self.nVDAs: return vdas
+            if disk.get_sec_property(vda, 'FID') != fid: return vdas
+            if disk.get_sec_property(vda, 'pageNumber') != page + LEADER_ADJUST: return vdas
+            located[page] = vda
+        return located
+
+    # Bit table is accessed directly in the sectors that hold it
+    def _get_bit_word(self, w):
+        idx = self.disk.KDH_bitTable + w
+        return self.get_word(idx % self.disk.DD_len, vda=self.bit_table_vdas[idx // self.disk.DD_len])
+
+    def _set_bit_word(self, w, v):
+        idx = self.disk.KDH_bitTable + w
+        self.set_word(idx % self.disk.DD_len, v, vda=self.bit_table_vdas[idx // self.disk.DD_len])
+
+    # Count free pages a word of the bit table at a time
+    def count_free_pages(self):
+        used = 0
+        for w in range((self.nVDAs + 15) // 16):
+            v = self._get_bit_word(w)
+            if (w+1) * 16 > self.nVDAs:
+                v &= (MINUS_ONE << ((w+1) * 16 - self.nVDAs)) & MINUS_ONE   # bits beyond last vda
+            used += bin(v).count("1")
+        return self.nVDAs - used
 
     # determine status of a page
     def is_page_free(self, vda):
         w = vda // 16
         b = vda % 16
-        r = self.get_word(self.disk.KDH_bitTable + w) & (0o100000 >> b)
+        r = self._get_bit_word(w) & (0o100000 >> b)
         return (r == 0)
 
     # set bit for page (1=used, 0=free)
     def set_page_bit(self, vda, bit_val, free_count_increment):
+        if not self.verified: self.verify()
         w = vda // 16
         b = vda % 16
-        v = self.get_word(self.disk.KDH_bitTable + w)
+        v = self._get_bit_word(w)
         if bit_val == 0:
             v &= ~(0o100000 >> b)
+            if vda < self.rover: self.rover = vda
         else:
             v |=  (0o100000 >> b)
-        self.set_word(self.disk.KDH_bitTable + w, v)
+        self._set_bit_word(w, v)
         self.set_word(KDH_freePages, self.get_word(KDH_freePages) + free_count_increment)
         
     # find a free page, mark it in use, return vda
+    # Lowest free vda, as always, but whole words of used pages are skipped
     def allocate_page(self):
-        for vda in range(self.nVDAs):
-            if self.is_page_free(vda):
-                self.set_page_bit(vda, 1, -1)
-                return vda
+        if not self.verified: self.verify()
+        for w in range(self.rover // 16, (self.nVDAs + 15) // 16):
+            v = self._get_bit_word(w)
+            if v == MINUS_ONE: continue
+            for b in range(16):
+                vda = w * 16 + b
+                if vda >= self.nVDAs: break
+                if vda >= self.rover and (v & (0o100000 >> b)) == 0:
+                    self.set_page_bit(vda, 1, -1)
+                    self.rover = vda + 1
+                    return vda
         raise Exception("Cannot allocate new page")
 
     # mark a page free
     def free_page(self, vda):
         self.set_page_bit(vda, 0, 1)
 
+    # mark many pages free, writing each word of the bit table and the free count once
+    def free_pages(self, vdas):
+        if not self.verified: self.verify()
+        words = {}
+        for vda in vdas:
+            words.setdefault(vda // 16, []).append(vda % 16)
+        freed = 0
+        for w in words:
+            v = self._get_bit_word(w)
+            for b in words[w]:
+                if v & (0o100000 >> b): freed += 1
+                v &= ~(0o100000 >> b)
+            self._set_bit_word(w, v)
+        if freed != 0:
+            self.set_word(KDH_freePages, self.get_word(KDH_freePages) + freed)
+        self.rover = min([self.rover] + list(vdas))
+
 
 
 
@@ -863,6 +2059,35 @@ class DiskDescriptor (File):
 DIR_ENTRY_FILE = 1
 DIR_ENTRY_FREE = 0
 
+# A file's entry in the directory, as returned by Directory.list() and lookup().  Fields
+# are attributes, and can also be used as in a dict: e['name'], e['leader_vda'], e['FP']
+# (only if asked for), and 'length' and 'type' where a caller has filled them in.
+
+class DirEntry(object):
+    __slots__ = ('name', 'leader_vda', 'FP', 'length', 'type')
+
+    def __init__(self, name, leader_vda):
+        self.name = name
+        self.leader_vda = leader_vda
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __repr__(self):
+        return "DirEntry(" + ", ".join(k + "=" + repr(self[k]) for k in self.__slots__ if k in self) + ")"
+
 class Directory (File):
     # Although the Alto file system could have subdirectories, they were never used.
     # So this code is written for one directory, but with minor modifications could
@@ -870,6 +2095,8 @@ class Directory (File):
 
     # SysDir. has a leader_vda = 1
 
+    __slots__ = ('name',)
+
     # All "names" passed to these directory routines must have a "." at the
     # end of the file name.
 
@@ -878,6 +2105,12 @@ class Directory (File):
         if self.leader_vda == -1:
             raise Exception("File system has no SysDir.")
         self.name = "SysDir."
+
+    # SysDir is always at vda 1, so after a change it is only indexed again
+    def refresh(self, changed, file_system):
+        if changed.isdisjoint(self.file_vdas): return False
+        self._index_file()
+        return True
 	
     # Directory -- examine DV beginning at word i and return length of block or -1 if EOF
     def _dir_entry_length(self, i):
@@ -907,18 +2140,18 @@ class Directory (File):
         return -1
 
     # Extract info from directory entry at idx
-    # Returns dict: name, leader_vda, [FP]
+    # Returns DirEntry: name, leader_vda, [FP]
     def _dir_entry_extract(self, idx, returnFP=False):
         # check for empty entry
         if self._dir_entry_type(idx) == DIR_ENTRY_FREE: return None
         vda = self.get_word(idx+5)
         nam = get_BCPL_string(lambda i: self.get_word(idx+6+i))
-        result = {'name':nam, 'leader_vda': vda}
+        result = DirEntry(nam, vda)
         if returnFP:
             fp = []
             for j in range(1,6): fp.append(self.get_word(idx+j))
             fp[3] = 0  # unused, but normal convention is that it's zero
-            result['FP'] = fp
+            result.FP = fp
         return result
 
     # Find a particular file in the directory
@@ -944,6 +2177,81 @@ class Directory (File):
         self._dir_entry_set(idx, DIR_ENTRY_FREE, this_len)
         return True
 
+    # Count entries and free space in the directory; returns dict
+    def usage(self):
+        result = {'dir_entries': 0, 'dir_free_entries': 0, 'dir_free_words': 0}
+        idx = 0
+        while True:
+            length = self._dir_entry_length(idx)
+            if length == -1 or length == 0: break  # EOF
+            if self._dir_entry_type(idx) == DIR_ENTRY_FILE:
+                result['dir_entries'] += 1
+            else:
+                result['dir_free_entries'] += 1
+                result['dir_free_words'] += length
+            idx += length
+        return result
+
+    # Rewrite the directory with its entries packed together at the start, in the same order,
+    # followed by free entries.  leader_vdas maps old leader vdas to new ones for moved files.
+    def compact(self, leader_vdas={}):
+        entries = self.list(True)
+        idx = 0
+        for e in entries:
+            FP = e['FP']
+            FP[4] = leader_vdas.get(FP[4], FP[4])
+            lenNeeded = 1 + len(FP) + (len(e['name'])+2) // 2
+            self._dir_entry_set(idx, DIR_ENTRY_FILE, lenNeeded)
+            for i in range(len(FP)):
+                self.set_word(idx+1+i, FP[i])
+            set_BCPL_string(lambda i,w:self.set_word(idx+1+len(FP)+i, w), e['name'])
+            idx += lenNeeded
+        # rest of the directory is free, in entries of the size remove() allows
+        while idx < self.length // 2:
+            free_len = min(self.length // 2 - idx, 999)
+            self._dir_entry_set(idx, DIR_ENTRY_FREE, free_len)
+            idx += free_len
+
+    # Find the files whose names match any of a list of patterns (as in fnmatch, ignoring case),
+    # in one pass over the directory.  Returns entries as from list(), in directory order.
+    def match(self, patterns, returnFP=False):
+        return [e for idx, e in self._match_entries(patterns, returnFP)]
+
+    def _match_entries(self, patterns, returnFP=False):
+        return [(idx, e) for idx, e in self._entries(returnFP)
+                if any(name_matches(e['name'], pat) for pat in patterns)]
+
+    # Remove the entries at a set of directory indexes in one pass, merging each with
+    # free entries next to it while the total length stays below 1000 words.  Free
+    # entries that do not touch a removed entry are left as they are.
+    def remove_entries(self, idxs):
+        idx = 0
+        run = []    # (idx, length) of consecutive free or removed entries
+        while True:
+            length = self._dir_entry_length(idx)
+            eof = length == -1 or length == 0
+            if not eof and (idx in idxs or self._dir_entry_type(idx) == DIR_ENTRY_FREE):
+                run.append((idx, length))
+            else:
+                if any(i in idxs for i, n in run): self._merge_free(run, idxs)
+                run = []
+            if eof: break
+            idx += length
+
+    # Make a run of consecutive free and removed entries into free entries of under 1000
+    # words; only the headers of entries that absorb a removed entry are written
+    def _merge_free(self, run, idxs):
+        i = 0
+        while i < len(run):
+            first, total = run[i]
+            j = i + 1
+            while j < len(run) and total + run[j][1] < 1000:
+                total += run[j][1]
+                j += 1
+            if any(idx in idxs for idx, n in run[i:j]):
+                self._dir_entry_set(first, DIR_ENTRY_FREE, total)
+            i = j
+
     # Add a file to the directory
     def add(self, nam, FP):
         lenNeeded = 1 + len(FP) + (len(nam)+2) // 2
@@ -971,14 +2279,16 @@ class Directory (File):
             
     # Parse an entire Alto disk directory
     def list(self, returnFP=False):
-        files = []
+        return [e for idx, e in self._entries(returnFP)]
+
+    # Generate (index, entry) for each file in the directory, entries as from _dir_entry_extract
+    def _entries(self, returnFP=False):
         idx = 0
         while True:
             length = self._dir_entry_length(idx)
             if length == -1 or length == 0: break  # EOF
             e = self._dir_entry_extract(idx, returnFP)
             if e is not None:
-                files.append(e)
-            idx += self._dir_entry_length(idx)
-        return files
+                yield idx, e
+            idx += length
 
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#
+# Measure the memory held by open disk images, as AFU holds them:
+#
+#   python membench.py disk-image ...
+#
+# For each image, reports the bytes allocated (and still held) to open the
+# file system, to index every file in SysDir, and to list the directory.
+# Needs Python 3 (tracemalloc).  Results for sample images are in README-AFU.txt.
+
+import sys, tracemalloc
+from altofs import *
+
+def held(before):
+    return tracemalloc.get_traced_memory()[0] - before
+
+def measure(fn):
+    base = tracemalloc.get_traced_memory()[0]
+    d = Disk.select(fn)
+    if d is None:
+        raise Exception("File " + fn + " not in a .dsk format.")
+    file_system = FileSystem(d)
+    opened = held(base)
+    start = tracemalloc.get_traced_memory()[0]
+    entries = file_system.directory.list()
+    listed = held(start)
+    start = tracemalloc.get_traced_memory()[0]
+    files = [File(e['leader_vda'], file_system) for e in entries]
+    indexed = held(start)
+    pages = sum(len(f.file_vdas) for f in files)
+    print("{0}: open {1} bytes, list {2} entries {3} bytes, index {4} files ({5} pages) {6} bytes".format(
+        fn, opened, len(entries), listed, len(files), pages, indexed))
+    return file_system, files
+
+if __name__ == "__main__":
+    tracemalloc.start()
+    kept = []   # keep every image open, as a process serving many images would
+    for fn in sys.argv[1:]:
+        kept.append(measure(fn))
+    print("total held for {0} images: {1} bytes".format(len(kept), tracemalloc.get_traced_memory()[0]))